@@ -1,30 +1,75 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
+import errno
+import signal
 import json
+import pickle
+import sqlite3
 import urllib.request
-import zlib
+import urllib.parse
+import urllib.error
+import http.client
+import threading
 import re
 import tempfile
-import subprocess
+import tarfile
 import shutil
 from io import BytesIO
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 DEFAULT_CONFIG = os.path.join(os.path.expanduser('~'), '.config/apt-rip/apt-rip.json')
 DEFAULT_DIST = 'eoan'
 DEFAULT_REPO = 'main'
 
 APT_RIP_ROOT = 'etc/apt-rip'
-DL_BUFFER_SIZE = 8196
+DL_BUFFER_SIZE = 128 * 1024
+DL_MAX_WORKERS = 8
+
+HTTP_REDIRECTS = (301, 302, 303, 307, 308)
+HTTP_MAX_REDIRECTS = 10
 
 PROGRESS_BAR_SIZE = 42
+PROGRESS_BAR_INNER_SIZE = PROGRESS_BAR_SIZE - 2
+PROGRESS_BAR_FILLED = '=' * PROGRESS_BAR_INNER_SIZE
+PROGRESS_BAR_EMPTY = ' ' * PROGRESS_BAR_INNER_SIZE
+PROGRESS_BAR_UNKNOWN = '?' * PROGRESS_BAR_INNER_SIZE
+
+INSTALLED_FIELDS = ('dist', 'repo', 'explicit', 'files', 'depends')
+INSTALLED_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS packages (
+        name TEXT PRIMARY KEY,
+        dist TEXT NOT NULL,
+        repo TEXT NOT NULL,
+        explicit INTEGER NOT NULL,
+        depends TEXT NOT NULL
+    )
+'''
+
+INDEX_VERSION = 2
+INDEX_FIELD_RE = re.compile(rb'^(Package|Version|Filename|Depends): (.*)$', re.MULTILINE)
+
+def update_terminal_width(*args):
+    global terminal_width
+    terminal_width = shutil.get_terminal_size().columns
+
+update_terminal_width()
+if hasattr(signal, 'SIGWINCH'):
+    signal.signal(signal.SIGWINCH, update_terminal_width)
 
 class ProgressBar:
     def __init__(self, msg, total):
         self.total = total
         self.progress = 0
+        self.bar_size = None
 
-        terminal_width = os.get_terminal_size()[0]
         text_size = terminal_width - 1 - PROGRESS_BAR_SIZE
 
         if len(msg) > text_size:
@@ -33,14 +78,187 @@ class ProgressBar:
             self.msg = msg + ' ' * (text_size - len(msg) + 1)
 
     def print(self, first = False):
-        if not first:
-            print('\x1bM\x1b[2K', end = '')
+        if self.total:
+            bar_size = self.progress * PROGRESS_BAR_INNER_SIZE // self.total
+        else:
+            bar_size = None
+
+        if not first and bar_size == self.bar_size:
+            return
+        self.bar_size = bar_size
 
-        if self.total is not None:
-            bar_size = (self.progress * (PROGRESS_BAR_SIZE - 2) // self.total)
-            print(self.msg + '[' + '=' * bar_size + ' ' * (PROGRESS_BAR_SIZE - 2 - bar_size) + ']')
+        if bar_size is not None:
+            bar = PROGRESS_BAR_FILLED[:bar_size] + PROGRESS_BAR_EMPTY[bar_size:]
         else:
-            print(self.msg + '[' + '?' * (PROGRESS_BAR_SIZE - 2) + ']')
+            bar = PROGRESS_BAR_UNKNOWN
+
+        sys.stderr.write('%s%s[%s]\n' % ('' if first else '\x1bM\x1b[2K', self.msg, bar))
+        sys.stderr.flush()
+
+class InstalledPackages:
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, 'installed_packages.db')
+        self.files_dir = os.path.join(root, 'files')
+        self.removed_files = []
+
+        # The store is only created on the first write, so read-only commands leave no trace
+        self.db = sqlite3.connect(self.path) if os.path.exists(self.path) else None
+
+    def __contains__(self, package):
+        if self.db is None:
+            return False
+        return self.db.execute('SELECT 1 FROM packages WHERE name = ?', (package,)).fetchone() is not None
+
+    def __getitem__(self, package):
+        info = self.get(package)
+        if info is None:
+            raise KeyError(package)
+        return info
+
+    def __setitem__(self, package, info):
+        self._create()
+        self.db.execute('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)', (
+            package,
+            info['dist'],
+            info['repo'],
+            1 if info['explicit'] else 0,
+            json.dumps(info['depends'])
+        ))
+        self._write_files(package, info['files'])
+
+    def __delitem__(self, package):
+        self.db.execute('DELETE FROM packages WHERE name = ?', (package,))
+        self.removed_files.append(self._files_path(package))
+
+    def get(self, package, fields = INSTALLED_FIELDS):
+        if self.db is None:
+            return None
+
+        query = 'SELECT %s FROM packages WHERE name = ?' % self._columns(fields)
+        row = self.db.execute(query, (package,)).fetchone()
+        if row is None:
+            return None
+        return self._info(fields, row)
+
+    def items(self, fields = INSTALLED_FIELDS):
+        if self.db is None:
+            return
+
+        query = 'SELECT %s FROM packages ORDER BY rowid' % self._columns(fields)
+        for row in self.db.execute(query):
+            yield row[0], self._info(fields, row)
+
+    def update(self, packages):
+        for package, info in packages.items():
+            self[package] = info
+
+    def commit(self):
+        if self.db is None:
+            return
+        self.db.commit()
+
+        # File lists are only deleted once the removal is committed
+        for path in self.removed_files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.removed_files = []
+
+    def _create(self):
+        if self.db is not None:
+            return
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute(INSTALLED_SCHEMA)
+
+    def _columns(self, fields):
+        return ', '.join(['name'] + [field for field in fields if field != 'files'])
+
+    def _info(self, fields, row):
+        info = dict(zip([field for field in fields if field != 'files'], row[1:]))
+        if 'explicit' in info:
+            info['explicit'] = bool(info['explicit'])
+        if 'depends' in info:
+            info['depends'] = json.loads(info['depends'])
+        if 'files' in fields:
+            info['files'] = self._read_files(row[0])
+        return info
+
+    def _files_path(self, package):
+        return os.path.join(self.files_dir, '%s.lst' % package)
+
+    def _read_files(self, package):
+        path = self._files_path(package)
+        if not os.path.exists(path):
+            return []
+        return read_file(path).decode().splitlines()
+
+    def _write_files(self, package, files):
+        write_file(self._files_path(package), ''.join(file + '\n' for file in files).encode())
+
+class ConnectionPool:
+    def __init__(self):
+        # http.client connections are not thread safe, so each thread gets its own
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.proxies = urllib.request.getproxies()
+
+    def get(self, url):
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ['http', 'https'] or self._proxied(parts):
+                return urllib.request.urlopen(url)
+
+            response = self._request(parts)
+            location = response.getheader('Location')
+            if response.status in HTTP_REDIRECTS and location is not None:
+                response.read()
+                url = urllib.parse.urljoin(url, location)
+                continue
+
+            if response.status != 200:
+                response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return response
+
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+
+    def _proxied(self, parts):
+        return parts.scheme in self.proxies and not urllib.request.proxy_bypass(parts.hostname)
+
+    def _request(self, parts):
+        key = (threading.get_ident(), parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path, parts.query, ''))
+
+        with self.lock:
+            conn = self.connections.get(key)
+
+        if conn is not None:
+            try:
+                return self._send(conn, path)
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed the idle connection, retry once on a fresh one
+                conn.close()
+
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.netloc)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc)
+
+        with self.lock:
+            self.connections[key] = conn
+        return self._send(conn, path)
+
+    def _send(self, conn, path):
+        conn.request('GET', path, headers = {'Connection': 'keep-alive'})
+        return conn.getresponse()
 
 class Installer:
     def __init__(self, args, config, index, installed, tmp_dir):
@@ -49,69 +267,160 @@ class Installer:
         self.index = index
         self.installed = installed
         self.new_installed = {}
+        self.new_files = set()
+        self.created_dirs = set()
+        self.download_dir = os.path.join(tmp_dir, 'download')
         self.install_dir = os.path.join(tmp_dir, 'install')
         self.extract_dir = os.path.join(tmp_dir, 'extract')
+        os.makedirs(self.install_dir)
+
+    def install(self, packages):
+        order = self.resolve(packages)
+        debs = self.download_all([package for package, _ in order])
 
-    def install(self, package, explicit):
-        if package in self.installed or package in self.new_installed:
-            if explicit:
+        for package, explicit in order:
+            self.install_package(package, explicit, debs[package])
+
+    def resolve(self, packages):
+        order = []
+        seen = set()
+        queue = deque()
+
+        for package in packages:
+            if package in seen or package in self.installed:
                 print('Package "%s" is already installed' % package)
-            return
+                continue
+            seen.add(package)
+            queue.append((package, True))
+
+        while queue:
+            package, explicit = queue.popleft()
+            order.append((package, explicit))
+
+            for dep in self.dependencies(package):
+                if dep not in seen and dep not in self.installed:
+                    seen.add(dep)
+                    queue.append((dep, False))
+
+        return order
+
+    def dependencies(self, package):
+        return self.index[package].get('depends', [])
 
-        dl_url = '%s/%s' % (self.config['mirror'], self.index[package]['filename'])
-        data = download(dl_url, show_progress = True)
-        deb = os.path.join(self.extract_dir, 'package.deb')
-        write_file(deb, data)
+    def download_all(self, packages):
+        debs = {}
+        if not packages:
+            return debs
 
-        result = subprocess.run(['ar', 'x', deb, 'data.tar.gz'], cwd = self.extract_dir, check = True, stderr = subprocess.PIPE)
-        if result.stderr != b'':
-            raise Exception('Failed to extract deb: ' + result.stderr.decode().strip())
+        bar = ProgressBar('Downloading %d packages' % len(packages), len(packages))
+        bar.print(True)
 
-        subprocess.run(['tar', 'xf', 'data.tar.gz'], cwd = self.extract_dir, check = True, stderr = subprocess.PIPE)
+        os.makedirs(self.download_dir, exist_ok = True)
+        try:
+            with ThreadPoolExecutor(max_workers = DL_MAX_WORKERS) as executor:
+                futures = {}
+                for package in packages:
+                    dl_url = '%s/%s' % (self.config['mirror'], self.index[package]['filename'])
+                    debs[package] = os.path.join(self.download_dir, '%s.deb' % package)
+                    futures[executor.submit(download, dl_url, debs[package])] = package
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # Don't wait for the rest of the closure before reporting the error
+                        for pending in futures:
+                            pending.cancel()
+                        raise Exception('Failed to download package "%s": %s' % (futures[future], e)) from e
+
+                    bar.progress += 1
+                    bar.print()
+        finally:
+            # Close the worker threads' connections now that they are done
+            connections.close()
+
+        return debs
+
+    def ensure_dir(self, directory):
+        if directory in self.created_dirs:
+            return
+        os.makedirs(directory, exist_ok = True)
+        self.created_dirs.add(directory)
+
+    def install_package(self, package, explicit, deb):
+        with tarfile.open(fileobj = read_deb_data(deb), mode = 'r|*') as tar:
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(self.extract_dir, filter = 'tar')
+            else:
+                tar.extractall(self.extract_dir)
         os.remove(deb)
-        os.remove(os.path.join(self.extract_dir, 'data.tar.gz'))
 
         package_files = []
-        for root, dirs, files in os.walk(self.extract_dir):
-            for file in files:
-                src_path = os.path.join(root, file)
-                rel_path = os.path.relpath(src_path, self.extract_dir)
-                package_files.append(rel_path)
+        for src_path, rel_path in iter_rel_files(self.extract_dir):
+            package_files.append(rel_path)
 
-                root_path = os.path.join(self.config['install_root'], rel_path)
-                install_path = os.path.join(self.install_dir, rel_path)
+            root_path = os.path.join(self.config['install_root'], rel_path)
+            install_path = os.path.join(self.install_dir, rel_path)
 
-                if os.path.exists(root_path):
-                    conflicting = root_path
-                elif os.path.exists(install_path):
-                    conflicting = install_path
-                else:
-                    conflicting = None
-
-                if conflicting is not None:
-                    raise Exception('File "%s" of package "%s" conflicts with existing file' % (conflicting, package))
-                move_file(src_path, install_path)
+            if rel_path in self.new_files:
+                conflicting = install_path
+            elif os.path.exists(root_path):
+                conflicting = root_path
+            else:
+                conflicting = None
 
-        dependencies = self.index[package]['depends'] if 'depends' in self.index[package] else []
+            if conflicting is not None:
+                raise Exception('File "%s" of package "%s" conflicts with existing file' % (conflicting, package))
+            self.ensure_dir(os.path.dirname(install_path))
+            move_file(src_path, install_path)
+            self.new_files.add(rel_path)
 
         install_info = {
             'dist': self.args.dist,
             'repo': self.args.repo,
             'explicit': explicit,
             'files': package_files,
-            'depends': [dep.split(' ')[0] for dep in dependencies]
+            'depends': self.dependencies(package)
         }
 
         self.new_installed[package] = install_info
 
-        for dep in dependencies:
-            dep_pkg = dep.split(' ')[0] # Ignore version
-            self.install(dep_pkg, False)
+def read_deb_data(path):
+    with open(path, 'rb') as f:
+        if f.read(8) != b'!<arch>\n':
+            raise Exception('Failed to extract deb: "%s" is not an ar archive' % path)
+
+        while True:
+            header = f.read(60)
+            if len(header) < 60:
+                raise Exception('Failed to extract deb: no data archive in "%s"' % path)
+
+            name = header[:16].decode().strip().rstrip('/')
+            size = int(header[48:58])
+            if name.startswith('data.tar'):
+                return BytesIO(f.read(size))
+
+            # Members are padded to an even size
+            f.seek(size + size % 2, os.SEEK_CUR)
+
+def iter_rel_files(root, prefix = ''):
+    with os.scandir(root) as entries:
+        for entry in entries:
+            rel_path = prefix + entry.name
+            if entry.is_dir(follow_symlinks = False):
+                yield from iter_rel_files(entry.path, rel_path + os.sep)
+            else:
+                yield entry.path, rel_path
 
 def move_file(src, dst):
-    if not os.path.exists(os.path.dirname(dst)):
-        os.makedirs(os.path.dirname(dst))
-    shutil.move(src, dst)
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The temporary directory is often on a different filesystem than install_root
+        shutil.copy2(src, dst, follow_symlinks = False)
+        os.remove(src)
 
 def write_file(path, data):
     directory = os.path.dirname(os.path.abspath(path))
@@ -139,18 +448,34 @@ def read_config(path):
     return default_config
 
 def read_installed(config):
-    path = os.path.join(config['install_root'], APT_RIP_ROOT, 'installed_packages.json')
-    if os.path.exists(path):
-        return json.loads(read_file(path))
-    return {}
+    root = os.path.join(config['install_root'], APT_RIP_ROOT)
+    installed = InstalledPackages(root)
+
+    # Migrate from the old JSON store
+    legacy_path = os.path.join(root, 'installed_packages.json')
+    if os.path.exists(legacy_path):
+        installed.update(json.loads(read_file(legacy_path)))
+        installed.commit()
+        os.remove(legacy_path)
+
+    return installed
+
+connections = ConnectionPool()
 
-def write_installed(config, installed):
-    path = os.path.join(config['install_root'], APT_RIP_ROOT, 'installed_packages.json')
-    write_file(path, json.dumps(installed, indent = 4).encode())
+def download(url, dest_path, *, show_progress = False):
+    directory = os.path.dirname(os.path.abspath(dest_path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(dest_path, 'wb') as f:
+        download_into(url, f, show_progress = show_progress)
 
-def download(url, *, show_progress = False):
-    response = urllib.request.urlopen(url)
-    data = bytearray()
+def download_into(url, f, *, show_progress = False):
+    for buf in download_chunks(url, show_progress = show_progress):
+        f.write(buf)
+
+def download_chunks(url, *, show_progress = False):
+    response = connections.get(url)
 
     if show_progress:
         cl = response.getheader('Content-Length')
@@ -158,70 +483,95 @@ def download(url, *, show_progress = False):
         bar = ProgressBar(url, int(cl) if cl is not None else None)
         bar.print(True)
 
+    # The buffer is reused, so chunks are only valid until the next one is requested
+    buf = memoryview(bytearray(DL_BUFFER_SIZE))
     while True:
-        buf = response.read(DL_BUFFER_SIZE)
-        if not buf:
+        n = response.readinto(buf)
+        if not n:
             break
 
         if show_progress:
-            bar.progress += len(buf)
+            bar.progress += n
             bar.print()
 
-        data += buf
-    return data
+        yield buf[:n]
+
+def iter_paragraphs(chunks):
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS + 16)
+    pending = b''
+
+    for buf in chunks:
+        pending += decompressor.decompress(buf)
+        start = 0
+        while True:
+            end = pending.find(b'\n\n', start)
+            if end < 0:
+                break
+            yield pending[start:end]
+            start = end + 2
+        pending = pending[start:]
+
+    pending += decompressor.flush()
+    if not decompressor.eof:
+        raise Exception('Error: Package index is incomplete or truncated')
+    yield from pending.split(b'\n\n')
 
 def read_package_index(config, dist, repo):
-    path = os.path.join(config['install_root'], APT_RIP_ROOT, 'package-indices', '%s-%s.json' % (dist, repo))
+    path = os.path.join(config['install_root'], APT_RIP_ROOT, 'package-indices', '%s-%s-v%d.pickle' % (dist, repo, INDEX_VERSION))
     if os.path.exists(path):
-        return json.loads(read_file(path))
+        return pickle.loads(read_file(path))
 
     url = '%s/dists/%s/%s/binary-amd64/Packages.gz' % (config['mirror'], dist, repo)
-    data = download(url, show_progress = True)
-    packages_info = zlib.decompress(data, zlib.MAX_WBITS + 16).decode('utf-8')
     packages = {}
 
-    for package_info in packages_info.split('\n\n'):
+    for package_info in iter_paragraphs(download_chunks(url, show_progress = True)):
         package = {}
-        if package_info == "":
-            break
+        name = None
 
-        for line in package_info.split('\n'):
-            if len(line) == 0 or line[0] == ' ':
-                continue
-            field, value = line.split(': ', 1)
-            if field in ['Version', 'Filename']:
-                package[field.lower()] = value
-            elif field == 'Package':
+        for match in INDEX_FIELD_RE.finditer(package_info):
+            field, value = match.group(1), match.group(2).decode('utf-8')
+            if field == b'Package':
                 name = value
-            elif field == 'Depends':
-                package['depends'] = value.split(', ')
+            elif field == b'Depends':
+                package['depends'] = [dep.partition(' ')[0] for dep in value.split(', ')] # Ignore version
+            else:
+                package[field.decode().lower()] = value
+
+        if name is None:
+            continue
 
         if name in packages:
             raise Exception('Error: Duplicate package "%s" in index' % name)
 
         packages[name] = package
-    write_file(path, json.dumps(packages, indent = 4).encode())
+    write_file(path, pickle.dumps(packages, protocol = pickle.HIGHEST_PROTOCOL))
     return packages
 
 def find_packages(index, query):
     return [name for name in index if query in name]
 
-def direct_reverse_dependencies(installed, package):
-    for rdep, info in installed.items():
-        if package in info['depends']:
-            yield rdep
+def reverse_dependencies(installed):
+    rdeps = defaultdict(set)
+    for package, info in installed.items(('depends',)):
+        for dep in info['depends']:
+            rdeps[dep].add(package)
+    return rdeps
+
+def direct_reverse_dependencies(rdeps, package):
+    return rdeps.get(package, set())
 
-def remove(config, installed, package, quiet):
-    if not package in installed:
+def remove(config, installed, rdeps, package, quiet):
+    info = installed.get(package, ('files', 'depends'))
+    if info is None:
         return
 
-    rdeps = list(direct_reverse_dependencies(installed, package))
-    if rdeps:
+    required_by = direct_reverse_dependencies(rdeps, package)
+    if required_by:
         if quiet:
             return
-        raise Exception('Package "%s" is required by %d other packages' % (package, len(rdeps)))
+        raise Exception('Package "%s" is required by %d other packages' % (package, len(required_by)))
 
-    for file in installed[package]['files']:
+    for file in info['files']:
         path = os.path.join(config['install_root'], file)
 
         if not os.path.exists(path):
@@ -234,11 +584,15 @@ def remove(config, installed, package, quiet):
         except:
             pass
 
-    deps = installed[package]['depends']
+    deps = info['depends']
     del installed[package]
     for dep in deps:
-        if dep in installed and not installed[dep]['explicit']:
-            remove(config, installed, dep, True)
+        rdeps[dep].discard(package)
+
+    for dep in deps:
+        info = installed.get(dep, ('explicit',))
+        if info is not None and not info['explicit']:
+            remove(config, installed, rdeps, dep, True)
 
 def cmd_search(args):
     config = read_config(args.config)
@@ -251,11 +605,12 @@ def cmd_search(args):
         return
 
     for result in results:
-        if result in installed:
+        info = installed.get(result, ('dist', 'repo', 'explicit'))
+        if info is not None:
             print(result, '[Installed, %s/%s%s]' % (
-                installed['dist'],
-                installed['repo'],
-                ', explicit' if installed['explicit'] else ''
+                info['dist'],
+                info['repo'],
+                ', explicit' if info['explicit'] else ''
             ))
         else:
             print(result)
@@ -277,18 +632,20 @@ def cmd_install(args):
                     'depends': []
                 }
 
-        write_installed(config, installed)
+        installed.commit()
         return
 
     index = read_package_index(config, args.dist, args.repo)
     packages = []
 
     for package in args.packages:
+        if package in index:
+            packages.append(package)
+            continue
+
         results = find_packages(index, package)
 
-        if package in results:
-            packages.append(package)
-        elif len(results) > 1:
+        if len(results) > 1:
             print('Error: Abiguous package name "%s" (found %s canidates)' % (package, len(results)))
             return
         elif len(results) == 0:
@@ -299,37 +656,35 @@ def cmd_install(args):
 
     with tempfile.TemporaryDirectory() as tmp:
         installer = Installer(args, config, index, installed, tmp)
-        for package in packages:
-            installer.install(package, True)
+        installer.install(packages)
 
-        for root, dirs, files in os.walk(installer.install_dir):
-            for file in files:
-                src_path = os.path.join(root, file)
-                rel_path = os.path.relpath(src_path, installer.install_dir)
-                dst_path = os.path.join(config['install_root'], rel_path)
-                move_file(src_path, dst_path)
+        for src_path, rel_path in iter_rel_files(installer.install_dir):
+            dst_path = os.path.join(config['install_root'], rel_path)
+            installer.ensure_dir(os.path.dirname(dst_path))
+            move_file(src_path, dst_path)
 
         installed.update(installer.new_installed)
-        write_installed(config, installed)
+        installed.commit()
 
 def cmd_remove(args):
     config = read_config(args.config)
     installed = read_installed(config)
 
+    rdeps = reverse_dependencies(installed)
     to_remove = []
 
     for package in args.packages:
         if package not in installed:
             raise Exception('Package "%s" is not installed' % package)
 
-        remove(config, installed, package, False)
-    write_installed(config, installed)
+        remove(config, installed, rdeps, package, False)
+    installed.commit()
 
 def cmd_list(args):
     config = read_config(args.config)
     installed = read_installed(config)
 
-    for package, info in installed.items():
+    for package, info in installed.items(('dist', 'repo', 'explicit')):
         print('%s, %s/%s%s' % (
             package,
             info['dist'],
@@ -348,10 +703,8 @@ def print_deptree(package, index, installed, depth):
     if package not in index:
         return
 
-    dependencies = index[package]['depends'] if 'depends' in index[package] else []
-    for dep in dependencies:
-        dep_pkg = dep.split(' ')[0] # Ignore version
-        print_deptree(dep_pkg, index, installed, depth + 1)
+    for dep in index[package].get('depends', []):
+        print_deptree(dep, index, installed, depth + 1)
 
 def cmd_deptree(args):
     config = read_config(args.config)